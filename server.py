@@ -1,24 +1,270 @@
+import asyncio
+import collections
+import contextlib
+import ctypes
+import hashlib
 import logging
 import os
-import glob
+import platform
+import queue
 import shutil
+import struct
 import subprocess
 import tempfile
+import threading
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, wait
 
-from fastapi import FastAPI, File, UploadFile, HTTPException
-from fastapi.responses import PlainTextResponse
+import av
+import numpy as np
+from fastapi import FastAPI, File, UploadFile, HTTPException, Request
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 
 logging.basicConfig(level=logging.INFO)
 app = FastAPI()
+# Transcripts are plain text and compress 5-10x; streamed chunks are compressed as
+# they are yielded, so compression overlaps with inference.
+app.add_middleware(GZipMiddleware, minimum_size=1024)
 
-MODEL_PATH       = os.path.join(os.path.dirname(__file__), "models", "ggml-small-q5_1.bin")
-BINARY           = "./main"
-CHUNK_DIR        = "chunks"
+# Quantized weights by default: q5_1 is under half the size of the FP16 file, roughly
+# halves RSS and runs ~2x faster on CPU (matmuls are memory-bandwidth bound),
+# for a small WER cost. Point WHISPER_MODEL at ggml-small.bin for full precision.
+MODEL_PATH       = os.environ.get(
+    "WHISPER_MODEL",
+    os.path.join(os.path.dirname(__file__), "models", "ggml-small-q5_1.bin")
+)
+VAD_MODEL_PATH   = os.environ.get(
+    "WHISPER_VAD_MODEL",
+    os.path.join(os.path.dirname(__file__), "models", "ggml-silero-v5.1.2.bin")
+)
+CACHE_DIR        = os.environ.get(
+    "WHISPER_CACHE_DIR",
+    os.path.join(os.path.dirname(__file__), "cache")
+)
+CACHE_MAX_FILES  = 1000   # least recently used transcripts are evicted beyond this
+LIB_PATH         = "./libwhisper.so"
+# Optional second build with a GPU backend, used when a GPU is detected at boot, e.g.
+#   cmake -B build-cuda -DGGML_CUDA=ON && cmake --build build-cuda -j
+#   ln -s build-cuda/src/libwhisper.so libwhisper-gpu.so
+GPU_LIB_PATH     = "./libwhisper-gpu.so"
+SAMPLE_RATE      = 16000
 CHUNK_DUR        = 35     # seconds
+CUT_SEARCH       = 5      # seconds at the end of a chunk searched for a quiet cut point
+CUT_FRAME        = 320    # 20 ms energy frames
 MAX_PARALLEL     = 2      # concurrent chunk workers
 WHISPER_THREADS  = os.cpu_count() or 2
+MAX_UPLOAD_BYTES = 500 << 20
+MAX_REQUESTS     = 8      # requests decoding/transcribing at once; more get a 503
+NO_SPEECH_THOLD  = 0.4    # whisper.cpp default is 0.6; lower gives up on silent windows sooner
+
+WHISPER_SAMPLING_GREEDY = 0
+
+# ctypes mirrors of the structs in include/whisper.h — keep in sync with the header
+class WhisperAheads(ctypes.Structure):
+    _fields_ = [
+        ("n_heads", ctypes.c_size_t),
+        ("heads",   ctypes.c_void_p),
+    ]
+
+class WhisperContextParams(ctypes.Structure):
+    _fields_ = [
+        ("use_gpu",              ctypes.c_bool),
+        ("flash_attn",           ctypes.c_bool),
+        ("gpu_device",           ctypes.c_int),
+        ("dtw_token_timestamps", ctypes.c_bool),
+        ("dtw_aheads_preset",    ctypes.c_int),
+        ("dtw_n_top",            ctypes.c_int),
+        ("dtw_aheads",           WhisperAheads),
+        ("dtw_mem_size",         ctypes.c_size_t),
+    ]
+
+class WhisperVadParams(ctypes.Structure):
+    _fields_ = [
+        ("threshold",               ctypes.c_float),
+        ("min_speech_duration_ms",  ctypes.c_int),
+        ("min_silence_duration_ms", ctypes.c_int),
+        ("max_speech_duration_s",   ctypes.c_float),
+        ("speech_pad_ms",           ctypes.c_int),
+        ("samples_overlap",         ctypes.c_float),
+    ]
+
+class WhisperVadContextParams(ctypes.Structure):
+    _fields_ = [
+        ("n_threads",  ctypes.c_int),
+        ("use_gpu",    ctypes.c_bool),
+        ("gpu_device", ctypes.c_int),
+    ]
+
+class WhisperGreedyParams(ctypes.Structure):
+    _fields_ = [("best_of", ctypes.c_int)]
+
+class WhisperBeamSearchParams(ctypes.Structure):
+    _fields_ = [
+        ("beam_size", ctypes.c_int),
+        ("patience",  ctypes.c_float),
+    ]
+
+class WhisperFullParams(ctypes.Structure):
+    _fields_ = [
+        ("strategy",                          ctypes.c_int),
+        ("n_threads",                         ctypes.c_int),
+        ("n_max_text_ctx",                    ctypes.c_int),
+        ("offset_ms",                         ctypes.c_int),
+        ("duration_ms",                       ctypes.c_int),
+        ("translate",                         ctypes.c_bool),
+        ("no_context",                        ctypes.c_bool),
+        ("no_timestamps",                     ctypes.c_bool),
+        ("single_segment",                    ctypes.c_bool),
+        ("print_special",                     ctypes.c_bool),
+        ("print_progress",                    ctypes.c_bool),
+        ("print_realtime",                    ctypes.c_bool),
+        ("print_timestamps",                  ctypes.c_bool),
+        ("token_timestamps",                  ctypes.c_bool),
+        ("thold_pt",                          ctypes.c_float),
+        ("thold_ptsum",                       ctypes.c_float),
+        ("max_len",                           ctypes.c_int),
+        ("split_on_word",                     ctypes.c_bool),
+        ("max_tokens",                        ctypes.c_int),
+        ("debug_mode",                        ctypes.c_bool),
+        ("audio_ctx",                         ctypes.c_int),
+        ("tdrz_enable",                       ctypes.c_bool),
+        ("suppress_regex",                    ctypes.c_char_p),
+        ("initial_prompt",                    ctypes.c_char_p),
+        ("prompt_tokens",                     ctypes.c_void_p),
+        ("prompt_n_tokens",                   ctypes.c_int),
+        ("language",                          ctypes.c_char_p),
+        ("detect_language",                   ctypes.c_bool),
+        ("suppress_blank",                    ctypes.c_bool),
+        ("suppress_nst",                      ctypes.c_bool),
+        ("temperature",                       ctypes.c_float),
+        ("max_initial_ts",                    ctypes.c_float),
+        ("length_penalty",                    ctypes.c_float),
+        ("temperature_inc",                   ctypes.c_float),
+        ("entropy_thold",                     ctypes.c_float),
+        ("logprob_thold",                     ctypes.c_float),
+        ("no_speech_thold",                   ctypes.c_float),
+        ("greedy",                            WhisperGreedyParams),
+        ("beam_search",                       WhisperBeamSearchParams),
+        ("new_segment_callback",              ctypes.c_void_p),
+        ("new_segment_callback_user_data",    ctypes.c_void_p),
+        ("progress_callback",                 ctypes.c_void_p),
+        ("progress_callback_user_data",       ctypes.c_void_p),
+        ("encoder_begin_callback",            ctypes.c_void_p),
+        ("encoder_begin_callback_user_data",  ctypes.c_void_p),
+        ("abort_callback",                    ctypes.c_void_p),
+        ("abort_callback_user_data",          ctypes.c_void_p),
+        ("logits_filter_callback",            ctypes.c_void_p),
+        ("logits_filter_callback_user_data",  ctypes.c_void_p),
+        ("grammar_rules",                     ctypes.c_void_p),
+        ("n_grammar_rules",                   ctypes.c_size_t),
+        ("i_start_rule",                      ctypes.c_size_t),
+        ("grammar_penalty",                   ctypes.c_float),
+        ("vad",                               ctypes.c_bool),
+        ("vad_model_path",                    ctypes.c_char_p),
+        ("vad_params",                        WhisperVadParams),
+    ]
+
+def load_libwhisper(path: str) -> ctypes.CDLL:
+    lib = ctypes.CDLL(path)
+
+    lib.whisper_context_default_params.restype = WhisperContextParams
+    lib.whisper_context_default_params.argtypes = []
+
+    lib.whisper_init_from_file_with_params_no_state.restype = ctypes.c_void_p
+    lib.whisper_init_from_file_with_params_no_state.argtypes = [ctypes.c_char_p, WhisperContextParams]
+
+    lib.whisper_init_state.restype = ctypes.c_void_p
+    lib.whisper_init_state.argtypes = [ctypes.c_void_p]
+
+    lib.whisper_free_state.restype = None
+    lib.whisper_free_state.argtypes = [ctypes.c_void_p]
+
+    lib.whisper_free.restype = None
+    lib.whisper_free.argtypes = [ctypes.c_void_p]
+
+    lib.whisper_full_default_params.restype = WhisperFullParams
+    lib.whisper_full_default_params.argtypes = [ctypes.c_int]
+
+    lib.whisper_full_with_state.restype = ctypes.c_int
+    lib.whisper_full_with_state.argtypes = [
+        ctypes.c_void_p, ctypes.c_void_p, WhisperFullParams,
+        ctypes.POINTER(ctypes.c_float), ctypes.c_int,
+    ]
+
+    lib.whisper_full_n_segments_from_state.restype = ctypes.c_int
+    lib.whisper_full_n_segments_from_state.argtypes = [ctypes.c_void_p]
+
+    lib.whisper_full_get_segment_text_from_state.restype = ctypes.c_char_p
+    lib.whisper_full_get_segment_text_from_state.argtypes = [ctypes.c_void_p, ctypes.c_int]
+
+    lib.whisper_print_system_info.restype = ctypes.c_char_p
+    lib.whisper_print_system_info.argtypes = []
+
+    # ggml symbols resolve through libwhisper's dependencies
+    lib.ggml_backend_reg_count.restype = ctypes.c_size_t
+    lib.ggml_backend_reg_count.argtypes = []
+
+    lib.ggml_backend_reg_get.restype = ctypes.c_void_p
+    lib.ggml_backend_reg_get.argtypes = [ctypes.c_size_t]
+
+    lib.ggml_backend_reg_name.restype = ctypes.c_char_p
+    lib.ggml_backend_reg_name.argtypes = [ctypes.c_void_p]
+
+    lib.whisper_vad_default_context_params.restype = WhisperVadContextParams
+    lib.whisper_vad_default_context_params.argtypes = []
+
+    lib.whisper_vad_default_params.restype = WhisperVadParams
+    lib.whisper_vad_default_params.argtypes = []
+
+    lib.whisper_vad_init_from_file_with_params.restype = ctypes.c_void_p
+    lib.whisper_vad_init_from_file_with_params.argtypes = [ctypes.c_char_p, WhisperVadContextParams]
+
+    lib.whisper_vad_free.restype = None
+    lib.whisper_vad_free.argtypes = [ctypes.c_void_p]
+
+    lib.whisper_vad_segments_from_samples.restype = ctypes.c_void_p
+    lib.whisper_vad_segments_from_samples.argtypes = [
+        ctypes.c_void_p, WhisperVadParams, ctypes.POINTER(ctypes.c_float), ctypes.c_int,
+    ]
+
+    lib.whisper_vad_segments_n_segments.restype = ctypes.c_int
+    lib.whisper_vad_segments_n_segments.argtypes = [ctypes.c_void_p]
+
+    lib.whisper_vad_segments_get_segment_t0.restype = ctypes.c_float
+    lib.whisper_vad_segments_get_segment_t0.argtypes = [ctypes.c_void_p, ctypes.c_int]
+
+    lib.whisper_vad_segments_get_segment_t1.restype = ctypes.c_float
+    lib.whisper_vad_segments_get_segment_t1.argtypes = [ctypes.c_void_p, ctypes.c_int]
+
+    lib.whisper_vad_free_segments.restype = None
+    lib.whisper_vad_free_segments.argtypes = [ctypes.c_void_p]
+
+    return lib
+
+# Loaded once at startup. The model weights live in `ctx` and are shared; each
+# thread of the shared `pool` owns a slot holding its own `whisper_state` and
+# Silero VAD context (None when no VAD model is installed), since neither is
+# reentrant, the disjoint set of cores its compute threads are pinned to, and
+# the whisper_full params it runs with (passed by value, so reused as is).
+WorkerSlot = collections.namedtuple("WorkerSlot", ["state", "vad", "cores", "params"])
+
+lib    = None
+ctx    = None
+requests_in_flight = asyncio.BoundedSemaphore(MAX_REQUESTS)
+slots  = []
+pool   = None
+worker = threading.local()
+
+def partition_cores(n_parts: int) -> list:
+    """Split the CPUs we may run on into n_parts disjoint sets (None = don't pin)."""
+    if not hasattr(os, "sched_getaffinity"):
+        return [None] * n_parts
+    cores = sorted(os.sched_getaffinity(0))
+    per_part = len(cores) // n_parts
+    if per_part == 0:
+        return [None] * n_parts
+    return [set(cores[i * per_part:(i + 1) * per_part]) for i in range(n_parts)]
 
 @app.on_event("startup")
 def startup_log():
@@ -27,122 +273,515 @@ def startup_log():
     logging.info(f"🚀 Max parallel chunks: {MAX_PARALLEL}")
     logging.info(f"📦 Detected CPU cores: {os.cpu_count()}")
 
-@app.post("/transcribe")
-async def transcribe(audio: UploadFile = File(...)):
-    if not os.path.isfile(MODEL_PATH):
-        raise HTTPException(500, f"Model not found at {MODEL_PATH}")
+def probe(cmd: list) -> str:
+    """Run a detection command, returning its stdout or "" if unavailable."""
+    if shutil.which(cmd[0]) is None:
+        return ""
+    try:
+        res = subprocess.run(cmd, capture_output=True, text=True, timeout=10)
+    except (OSError, subprocess.TimeoutExpired):
+        return ""
+    return res.stdout.strip() if res.returncode == 0 else ""
 
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".tmp") as tmp:
-        tmp.write(await audio.read())
-        tmp_in = tmp.name
+def detect_gpu():
+    """Return a short description of a usable GPU, or None."""
+    if platform.system() == "Darwin":
+        return "Metal"
+    nvidia = probe(["nvidia-smi", "-L"])
+    if nvidia:
+        return nvidia.splitlines()[0]
+    vulkan = probe(["vulkaninfo", "--summary"])
+    if "DISCRETE_GPU" in vulkan or "INTEGRATED_GPU" in vulkan:
+        return "Vulkan"
+    return None
 
-    tmp_wav = tmp_in + ".wav"
-    os.makedirs(CHUNK_DIR, exist_ok=True)
+def check_build() -> bool:
+    """Log how libwhisper was compiled, warn about missing fast paths, and
+    return True if a GPU backend is available."""
+    info = lib.whisper_print_system_info().decode()
+    backends = [
+        lib.ggml_backend_reg_name(lib.ggml_backend_reg_get(i)).decode()
+        for i in range(lib.ggml_backend_reg_count())
+    ]
+    logging.info(f"🧮 System info: {info}")
+    logging.info(f"🧮 ggml backends: {', '.join(backends)}")
 
-    try:
-        # Convert to WAV
-        t0 = time.perf_counter()
-        subprocess.run(
-            ["ffmpeg", "-y", "-i", tmp_in, "-ar", "16000", "-ac", "1", tmp_wav],
-            check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-        )
-        logging.info(f"🎧 ffmpeg convert time: {time.perf_counter() - t0:.2f}s")
-
-        # Probe duration
-        ff = subprocess.run(
-            [
-                "ffprobe", "-v", "error",
-                "-show_entries", "format=duration",
-                "-of", "default=noprint_wrappers=1:nokey=1",
-                tmp_wav
-            ],
-            capture_output=True, text=True
+    gpu_backends = [b for b in backends if b not in ("CPU", "BLAS")]
+    if gpu_backends:
+        return True
+
+    if platform.machine().lower() in ("x86_64", "amd64"):
+        missing = [f for f in ("AVX2", "FMA") if f"{f} = 1" not in info]
+        if missing:
+            logging.warning(
+                f"⚠️ libwhisper built without {', '.join(missing)} — CPU inference will be "
+                f"several times slower; rebuild with -DGGML_NATIVE=ON on the target machine"
+            )
+    if "BLAS" not in backends:
+        logging.warning(
+            "⚠️ libwhisper built without BLAS — rebuild with "
+            "-DGGML_BLAS=ON -DGGML_BLAS_VENDOR=OpenBLAS for faster encoding"
         )
+    return False
+
+@app.on_event("startup")
+def load_model():
+    global lib, ctx, pool, MAX_PARALLEL
+    if not os.path.isfile(MODEL_PATH):
+        logging.error(f"❌ Model not found at {MODEL_PATH}")
+        return
+
+    t0 = time.perf_counter()
+    lib_path = LIB_PATH
+    gpu = detect_gpu()
+    if gpu:
+        logging.info(f"🎮 GPU detected: {gpu}")
+        if os.path.exists(GPU_LIB_PATH):
+            lib_path = GPU_LIB_PATH
+    lib = load_libwhisper(lib_path)
+    logging.info(f"📚 Loaded {lib_path}")
+    # Start reading the weights into the page cache ahead of whisper's own freads
+    if hasattr(os, "posix_fadvise"):
+        fd = os.open(MODEL_PATH, os.O_RDONLY)
         try:
-            duration = float(ff.stdout.strip())
-        except:
-            duration = 0.0
-        logging.info(f"🎙 Audio duration: {duration:.2f}s")
-
-        # Short audio (no chunking)
-        if duration <= CHUNK_DUR:
-            logging.info("✅ Short audio — skipping chunking.")
-            t1 = time.perf_counter()
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+    if check_build():
+        # One GPU runs one stream at a time; parallel chunks would only queue on
+        # the device, so use a single worker that gets every core for the CPU side.
+        MAX_PARALLEL = 1
+        logging.info("🚀 GPU backend in use — max parallel chunks: 1")
+    ctx = lib.whisper_init_from_file_with_params_no_state(
+        MODEL_PATH.encode(), lib.whisper_context_default_params()
+    )
+    if not ctx:
+        raise RuntimeError(f"Failed to load model from {MODEL_PATH}")
+    use_vad = os.path.isfile(VAD_MODEL_PATH)
+    if not use_vad:
+        logging.warning(f"⚠️ VAD model not found at {VAD_MODEL_PATH} — silence will not be trimmed")
+    for cores in partition_cores(MAX_PARALLEL):
+        state = lib.whisper_init_state(ctx)
+        if not state:
+            raise RuntimeError("Failed to allocate whisper state")
+        vad = None
+        if use_vad:
+            vad = lib.whisper_vad_init_from_file_with_params(
+                VAD_MODEL_PATH.encode(), lib.whisper_vad_default_context_params()
+            )
+            if not vad:
+                raise RuntimeError(f"Failed to load VAD model from {VAD_MODEL_PATH}")
+        n_threads = min(WHISPER_THREADS, len(cores)) if cores else WHISPER_THREADS
+        slots.append(WorkerSlot(state, vad, cores, full_params(n_threads)))
+        if cores:
+            logging.info(f"📌 Worker pinned to cores {sorted(cores)}")
+
+    # One pool for all requests: its threads (and their slots) live as long as
+    # the server instead of being spawned and torn down per request
+    unclaimed = queue.Queue()
+    for slot in slots:
+        unclaimed.put(slot)
+    pool = ThreadPoolExecutor(
+        max_workers=MAX_PARALLEL, thread_name_prefix="whisper",
+        initializer=init_worker, initargs=(unclaimed,)
+    )
+    logging.info(f"📥 Model load time: {time.perf_counter() - t0:.2f}s")
+
+    # Prime every worker with one inference on silence so the first request
+    # doesn't pay for thread spawn, pinning and first-run compute setup
+    t0 = time.perf_counter()
+    barrier = threading.Barrier(MAX_PARALLEL)
+    for fut in [pool.submit(warm_up, barrier) for _ in range(MAX_PARALLEL)]:
+        fut.result()
+    logging.info(f"🔥 Warm-up time: {time.perf_counter() - t0:.2f}s")
+
+def init_worker(unclaimed: queue.Queue):
+    # Each pool thread keeps one slot for its lifetime, so the ggml threads it
+    # spawns inherit a stable CPU mask and concurrent chunks don't migrate
+    # across and evict each other's caches
+    worker.slot = unclaimed.get_nowait()
+    if worker.slot.cores:
+        os.sched_setaffinity(0, worker.slot.cores)
+
+def warm_up(barrier: threading.Barrier):
+    # Holding each task until all have started forces one per pool thread
+    barrier.wait()
+    run_whisper(np.zeros(SAMPLE_RATE, dtype=np.float32), use_vad=False)
+
+@app.on_event("shutdown")
+def free_model():
+    global ctx
+    if pool:
+        pool.shutdown(wait=True, cancel_futures=True)
+    while slots:
+        slot = slots.pop()
+        lib.whisper_free_state(slot.state)
+        if slot.vad:
+            lib.whisper_vad_free(slot.vad)
+    if ctx:
+        lib.whisper_free(ctx)
+        ctx = None
+
+def speech_span(vad, samples: np.ndarray):
+    """Return the (start, end) sample range containing speech, or None if there is none."""
+    segments = lib.whisper_vad_segments_from_samples(
+        vad, lib.whisper_vad_default_params(),
+        samples.ctypes.data_as(ctypes.POINTER(ctypes.c_float)), len(samples)
+    )
+    if not segments:
+        return 0, len(samples)  # VAD failed — transcribe everything rather than drop audio
+    try:
+        n_segments = lib.whisper_vad_segments_n_segments(segments)
+        if n_segments == 0:
+            return None
+        # segment times are in centiseconds
+        t0 = lib.whisper_vad_segments_get_segment_t0(segments, 0)
+        t1 = lib.whisper_vad_segments_get_segment_t1(segments, n_segments - 1)
+    finally:
+        lib.whisper_vad_free_segments(segments)
+    return int(t0 * SAMPLE_RATE / 100), min(len(samples), int(t1 * SAMPLE_RATE / 100) + 1)
+
+def full_params(n_threads: int) -> WhisperFullParams:
+    """The one whisper_full configuration every chunk runs with."""
+    params = lib.whisper_full_default_params(WHISPER_SAMPLING_GREEDY)
+    params.n_threads        = n_threads
+    params.no_timestamps    = True
+    params.print_progress   = False
+    params.print_realtime   = False
+    params.print_timestamps = False
+    params.no_speech_thold  = NO_SPEECH_THOLD
+    return params
+
+def run_whisper(samples: np.ndarray, use_vad: bool = True) -> bytes:
+    """Transcribe samples on the calling pool thread's slot."""
+    slot = worker.slot
+
+    # Only pay encoder/decoder cost for the speech-active part of the chunk
+    if use_vad and slot.vad:
+        span = speech_span(slot.vad, samples)
+        if span is None:
+            logging.info("🤫 No speech detected — skipping chunk")
+            return b""
+        samples = samples[span[0]:span[1]]
+
+    rc = lib.whisper_full_with_state(
+        ctx, slot.state, slot.params,
+        samples.ctypes.data_as(ctypes.POINTER(ctypes.c_float)), len(samples)
+    )
+    if rc != 0:
+        raise RuntimeError(f"whisper_full failed rc={rc}")
+    # Segment text stays UTF-8 bytes end to end: it is written to the socket and
+    # the cache as is, and a segment may end inside a multi-byte character
+    n_segments = lib.whisper_full_n_segments_from_state(slot.state)
+    return b"".join(
+        lib.whisper_full_get_segment_text_from_state(slot.state, i) + b"\n"
+        for i in range(n_segments)
+    )
+
+def cache_path(key: str) -> str:
+    # Transcripts depend on the model, so each model gets its own namespace
+    model = os.path.splitext(os.path.basename(MODEL_PATH))[0]
+    return os.path.join(CACHE_DIR, model, f"{key}.txt")
+
+# The cache is best effort: any filesystem error is logged and the request
+# carries on as if the entry were missing.
+def cache_load(key: str) -> bytes | None:
+    path = cache_path(key)
+    try:
+        with open(path, "rb") as f:
+            text = f.read()
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        logging.warning(f"⚠️ Transcript cache unreadable: {e}")
+        return None
+    # Bump mtime so eviction keeps recently used entries
+    with contextlib.suppress(OSError):
+        os.utime(path)
+    return text
+
+def cache_store(key: str, text: bytes):
+    path = cache_path(key)
+    cache_dir = os.path.dirname(path)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile("wb", dir=cache_dir, suffix=".tmp", delete=False) as f:
             try:
-                res = subprocess.run(
-                    [
-                        BINARY, "-m", MODEL_PATH,
-                        "-f", tmp_wav,
-                        "-otxt", "-of", "-",
-                        "-nt", "-np",
-                        "-t", str(WHISPER_THREADS)
-                    ],
-                    check=True, capture_output=True, text=True
-                )
-                logging.info(f"⏱ whisper.cpp runtime: {time.perf_counter() - t1:.2f}s")
-                return PlainTextResponse(res.stdout)
-            except subprocess.CalledProcessError as e:
-                raise HTTPException(
-                    500,
-                    detail=f"Whisper failed (rc={e.returncode}): {e.stderr.strip()}"
-                )
-
-        # Long audio — chunk
-        t2 = time.perf_counter()
-        subprocess.run(
-            [
-                "ffmpeg", "-y", "-i", tmp_wav,
-                "-f", "segment", "-segment_time", str(CHUNK_DUR),
-                "-ar", "16000", "-ac", "1", "-c:a", "pcm_s16le",
-                os.path.join(CHUNK_DIR, "chunk_%03d.wav")
-            ],
-            check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+                f.write(text)
+            except OSError:
+                f.close()
+                os.remove(f.name)
+                raise
+        os.replace(f.name, path)
+    except OSError as e:
+        logging.warning(f"⚠️ Could not cache transcript: {e}")
+        return
+
+    # Concurrent requests evict from the same directory, so entries may vanish
+    # between listing, stat and remove
+    def mtime(e: os.DirEntry) -> float:
+        try:
+            return e.stat().st_mtime
+        except FileNotFoundError:
+            return 0
+    try:
+        entries = [e for e in os.scandir(cache_dir) if e.name.endswith(".txt")]
+        if len(entries) > CACHE_MAX_FILES:
+            entries.sort(key=mtime)
+            for e in entries[:-CACHE_MAX_FILES]:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(e.path)
+    except OSError as e:
+        logging.warning(f"⚠️ Cache eviction failed: {e}")
+
+def quiet_cut(block: np.ndarray) -> int:
+    """Cut point in the quietest 20 ms frame of the last CUT_SEARCH seconds of
+    block, so chunk boundaries land in pauses rather than mid-word."""
+    n = CUT_SEARCH * SAMPLE_RATE // CUT_FRAME
+    start = len(block) - n * CUT_FRAME
+    frames = block[start:].reshape(n, CUT_FRAME)
+    energy = np.einsum("ij,ij->i", frames, frames)
+    # Latest of equally quiet frames, to keep chunks close to CHUNK_DUR
+    quietest = n - 1 - int(np.argmin(energy[::-1]))
+    return start + quietest * CUT_FRAME + CUT_FRAME // 2
+
+def wav_pcm16_size(f) -> int:
+    """Byte size of the sample data if f is a 16 kHz mono 16-bit PCM WAV, leaving f
+    positioned at the first sample (0xFFFFFFFF: read to EOF); otherwise rewind f
+    and return 0."""
+    hdr = f.read(12)
+    if len(hdr) == 12 and hdr[:4] == b"RIFF" and hdr[8:] == b"WAVE":
+        fmt = None
+        while len(chunk := f.read(8)) == 8:
+            cid, size = struct.unpack("<4sI", chunk)
+            if cid == b"fmt ":
+                body = f.read(size + (size & 1))
+                fmt = struct.unpack("<HHIIHH", body[:16]) if len(body) >= 16 else None
+            elif cid == b"data":
+                # (format tag, channels, rate, byte rate, block align, bits)
+                if fmt and fmt[:3] == (1, 1, SAMPLE_RATE) and fmt[5] == 16:
+                    # Streaming recorders leave the size 0 (or 0xFFFFFFFF) unpatched
+                    return size or 0xFFFFFFFF
+                break
+            else:
+                f.seek(size + (size & 1), os.SEEK_CUR)
+    f.seek(0)
+    return 0
+
+class UploadLimit:
+    """Refuse oversized uploads from the header, before the body is spooled to disk.
+    Plain ASGI: @app.middleware("http") hides client disconnects from the handler."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            length = dict(scope["headers"]).get(b"content-length", b"")
+            if length.isdigit() and int(length) > MAX_UPLOAD_BYTES:
+                response = JSONResponse({"detail": "Upload too large."}, status_code=413)
+                await response(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+
+app.add_middleware(UploadLimit)
+
+@app.post("/transcribe")
+async def transcribe(request: Request, audio: UploadFile = File(...)):
+    if not ctx:
+        raise HTTPException(500, f"Model not loaded from {MODEL_PATH}")
+    # Chunked uploads carry no Content-Length, so check what was actually received
+    if audio.size is not None and audio.size > MAX_UPLOAD_BYTES:
+        raise HTTPException(413, "Upload too large.")
+
+    # Identical uploads are answered from the transcript cache without decoding;
+    # hashing the spooled upload runs at GB/s, negligible next to inference
+    key = (await asyncio.to_thread(hashlib.file_digest, audio.file, "sha256")).hexdigest()
+    cached = await asyncio.to_thread(cache_load, key)
+    if cached is not None:
+        logging.info(f"♻️ Cache hit {key[:12]}")
+        return Response(content=cached, media_type="text/plain; charset=utf-8")
+    await audio.seek(0)
+
+    # Shed load instead of queueing without bound: each request holds a spooled
+    # upload, a decode thread and decoded chunks until its work is done. The
+    # decode thread gives the permit back, so it returns however the response
+    # ends, including clients that never read it.
+    if requests_in_flight.locked():
+        raise HTTPException(503, "Server busy, retry later.")
+    await requests_in_flight.acquire()
+
+    # Decode in-process with libav to mono 16 kHz float32 PCM and hand each
+    # CHUNK_DUR block to whisper as soon as it fills, so decode and inference
+    # overlap. PyAV reads the spooled upload directly — no fork, no pipes.
+    # Uploads already in whisper's format (16 kHz mono s16 WAV) skip libav and
+    # are just scaled to float.
+    t0 = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    done = asyncio.Queue()   # (index, future) as chunks finish; (n_chunks, None) once decoding ends
+    submitted = []
+    cancelled = threading.Event()
+    decode_error = []   # corrupt input: keep what decoded before it
+    decode_failed = []  # anything else: the request fails
+    # At most MAX_PARALLEL of this request's chunks are queued or running at a
+    # time, so concurrent requests interleave fairly in the shared pool and
+    # decoding never runs far ahead of inference
+    in_flight = threading.BoundedSemaphore(MAX_PARALLEL)
+
+    def process_chunk(i: int, samples: np.ndarray) -> bytes:
+        t_chunk = time.perf_counter()
+        try:
+            text = run_whisper(samples)
+        except RuntimeError as e:
+            raise RuntimeError(f"chunk {i} failed: {e}")
+        logging.info(f"🧩 chunk {i} done in {time.perf_counter() - t_chunk:.2f}s")
+        return text
+
+    def submit(i: int, samples: np.ndarray) -> bool:
+        in_flight.acquire()
+        if cancelled.is_set():
+            return False
+        fut = pool.submit(process_chunk, i, samples)
+        submitted.append(fut)
+        fut.add_done_callback(lambda f: in_flight.release())
+        fut.add_done_callback(
+            lambda f: loop.call_soon_threadsafe(done.put_nowait, (i, f))
         )
-        logging.info(f"🔪 Chunking time: {time.perf_counter() - t2:.2f}s")
-
-        # Collect chunks
-        chunks = sorted(glob.glob(os.path.join(CHUNK_DIR, "*.wav")))
-        if not chunks:
-            raise HTTPException(500, "No audio chunks were created.")
-        for p in chunks:
-            logging.info(f"📦 Chunk {os.path.basename(p)} → {os.path.getsize(p)} bytes")
-
-        # Transcribe each chunk
-        def process_chunk(path: str) -> str:
-            t_chunk = time.perf_counter()
+        return True
+
+    def resampled(container):
+        resampler = av.AudioResampler(format="flt", layout="mono", rate=SAMPLE_RATE)
+        for frame in container.decode(audio=0):
+            for out in resampler.resample(frame):
+                yield out.to_ndarray().ravel()
+        for out in resampler.resample(None):  # flush
+            yield out.to_ndarray().ravel()
+
+    def wav_samples(n_bytes: int):
+        while n_bytes > 0:
+            raw = audio.file.read(min(n_bytes, 1 << 20))
+            raw = raw[:len(raw) & ~1]
+            if not raw:
+                break
+            n_bytes -= len(raw)
+            yield np.frombuffer(raw, dtype=np.int16) * np.float32(1 / 32768)
+
+    def decode():
+        chunk_len = CHUNK_DUR * SAMPLE_RATE
+        block = np.empty(chunk_len, dtype=np.float32)
+        filled = 0
+        n_samples = 0
+        i = 0
+        try:
             try:
-                out = subprocess.run(
-                    [
-                        BINARY, "-m", MODEL_PATH, "-f", path,
-                        "-otxt", "-of", "-", "-nt", "-np",
-                        "-t", str(WHISPER_THREADS)
-                    ],
-                    check=True, capture_output=True, text=True
-                )
-                logging.info(f"🧩 {os.path.basename(path)} done in {time.perf_counter() - t_chunk:.2f}s")
-                return out.stdout
-            except subprocess.CalledProcessError as e:
-                hint = " (SIGKILL/oom)" if e.returncode == -9 else ""
-                raise RuntimeError(
-                    f"{os.path.basename(path)} failed rc={e.returncode}{hint}\n"
-                    f"{e.stderr.strip()}"
-                )
-
-        results = {}
-        with ThreadPoolExecutor(max_workers=MAX_PARALLEL) as pool:
-            futures = {pool.submit(process_chunk, p): p for p in chunks}
-            for fut in as_completed(futures):
-                p = futures[fut]
-                try:
-                    results[p] = fut.result()
-                except RuntimeError as e:
-                    raise HTTPException(500, detail=str(e))
-
-        ordered = [results[p] for p in chunks]
-        return PlainTextResponse("\n".join(ordered))
+                with contextlib.ExitStack() as stack:
+                    if n_bytes := wav_pcm16_size(audio.file):
+                        source = wav_samples(n_bytes)
+                    else:
+                        source = resampled(stack.enter_context(av.open(audio.file, mode="r")))
+                    for pcm in source:
+                        if cancelled.is_set():
+                            return
+                        n_samples += len(pcm)
+                        while len(pcm):
+                            take = min(chunk_len - filled, len(pcm))
+                            block[filled:filled + take] = pcm[:take]
+                            filled += take
+                            pcm = pcm[take:]
+                            if filled == chunk_len:
+                                # Split at a pause and carry the rest into the next chunk
+                                cut = quiet_cut(block)
+                                if not submit(i, block[:cut]):
+                                    return
+                                tail = block[cut:]
+                                block = np.empty(chunk_len, dtype=np.float32)
+                                filled = len(tail)
+                                block[:filled] = tail
+                                i += 1
+            except (av.FFmpegError, IndexError) as e:
+                # Keep whatever decoded before a corrupt tail, like the ffmpeg CLI
+                # (IndexError: the container has no audio stream)
+                decode_error.append(e)
+                logging.warning(f"⚠️ Decode stopped after {n_samples / SAMPLE_RATE:.2f}s: {e}")
+            if filled and submit(i, block[:filled]):
+                i += 1
+        except Exception as e:
+            # Not a bad file (e.g. the upload was closed under us): fail the
+            # request rather than return a silently truncated transcript
+            decode_failed.append(e)
+            logging.exception("❌ Decode failed")
+        finally:
+            logging.info(f"🎧 Decode time: {time.perf_counter() - t0:.2f}s")
+            logging.info(f"🎙 Audio duration: {n_samples / SAMPLE_RATE:.2f}s, {i} chunks")
+            loop.call_soon_threadsafe(done.put_nowait, (i, None))
+            # The request's permit covers this thread and every chunk it queued
+            wait(submitted)
+            loop.call_soon_threadsafe(requests_in_flight.release)
 
-    finally:
-        for f in (tmp_in, tmp_wav):
-            if os.path.exists(f):
-                os.remove(f)
-        shutil.rmtree(CHUNK_DIR, ignore_errors=True)
+    def cleanup():
+        cancelled.set()
+        for fut in submitted:
+            fut.cancel()
+
+    threading.Thread(target=decode, daemon=True).start()
+
+    async def in_order():
+        # Emit each transcript as soon as every chunk before it is done, holding
+        # only out-of-order results; a failed chunk raises immediately instead
+        # of after all of its predecessors.
+        pending = {}
+        next_idx = 0
+        n_chunks = None
+        while n_chunks is None or next_idx < n_chunks:
+            i, fut = await done.get()
+            if fut is None:
+                if decode_failed:
+                    raise RuntimeError(f"Decoding failed: {decode_failed[0]}")
+                n_chunks = i
+                continue
+            pending[i] = fut.result()
+            while next_idx in pending:
+                yield pending.pop(next_idx)
+                next_idx += 1
+
+    texts = in_order()
+
+    # Resolve the first chunk before committing to a 200 so that decode and
+    # whisper errors on short audio still surface as a proper status code.
+    # Meanwhile watch for the client going away, so an abandoned request stops
+    # decoding and drops its queued chunks instead of running to completion.
+    first = asyncio.ensure_future(anext(texts))
+    try:
+        while not (await asyncio.wait({first}, timeout=1))[0]:
+            if await request.is_disconnected():
+                logging.info("🔌 Client disconnected — cancelling")
+                first.cancel()
+                cleanup()
+                return Response(status_code=499)
+        first_text = first.result()
+    except StopAsyncIteration:
+        cleanup()
+        if decode_error:
+            raise HTTPException(500, detail=f"Decoding failed: {decode_error[0]}")
+        raise HTTPException(500, "No audio decoded from upload.")
+    except RuntimeError as e:
+        cleanup()
+        raise HTTPException(500, detail=str(e))
+    except BaseException:
+        first.cancel()
+        cleanup()
+        raise
+
+    async def stream():
+        parts = [first_text]
+        try:
+            yield first_text
+            async for text in texts:
+                parts.append(b"\n" + text)
+                yield parts[-1]
+            logging.info(f"⏱ Total time: {time.perf_counter() - t0:.2f}s")
+            await asyncio.to_thread(cache_store, key, b"".join(parts))
+        finally:
+            cleanup()
+
+    return StreamingResponse(stream(), media_type="text/plain; charset=utf-8")